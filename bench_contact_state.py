@@ -0,0 +1,80 @@
+"""
+Mémoire de l'état des contacts : 3 defaultdicts (datetime / bool) vs ContactTable.
+
+    python bench_contact_state.py --contacts 1000000
+
+Les wa_id sont créés à l'intérieur de chaque mesure, comme en production où ils
+ne sont retenus que par l'état des contacts.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from contact_state import ContactTable
+
+BASE = datetime(2025, 9, 19, 18, 0)
+EPOCH = datetime(1970, 1, 1)
+
+
+def measure(build, contacts):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = build(contacts)
+    elapsed = time.perf_counter() - t0
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, current, elapsed
+
+
+def build_dicts(contacts):
+    last_user_at = defaultdict(lambda: None)
+    last_bot_at = defaultdict(lambda: None)
+    followup_sent = defaultdict(lambda: False)
+    for i in range(contacts):
+        w = f"33{600000000 + i}"
+        at = BASE + timedelta(seconds=i)
+        last_user_at[w] = at
+        last_bot_at[w] = at + timedelta(seconds=5)
+        followup_sent[w] = i % 3 == 0
+    return last_user_at, last_bot_at, followup_sent
+
+
+def build_table(contacts):
+    table = ContactTable()
+    base = (BASE - EPOCH) // timedelta(seconds=1)
+    for i in range(contacts):
+        w = f"33{600000000 + i}"
+        table.touch_user(w, base + i)
+        table.touch_bot(w, base + i + 5, followup=i % 3 == 0)
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", type=int, default=1_000_000)
+    args = parser.parse_args()
+    n = args.contacts
+
+    dicts, dict_bytes, dict_s = measure(build_dicts, n)
+    del dicts
+    table, table_bytes, table_s = measure(build_table, n)
+
+    now = (BASE - EPOCH) // timedelta(seconds=1) + n
+    t0 = time.perf_counter()
+    due = table.due_followups(now, 5 * 60, 24 * 3600)
+    sweep_ms = (time.perf_counter() - t0) * 1000
+
+    mb = 2 ** 20
+    print(f"contacts          : {n}")
+    print(f"3 defaultdicts    : {dict_bytes / mb:8.1f} Mo ({dict_bytes / n:.0f} o/contact, build {dict_s:.1f} s)")
+    print(f"ContactTable      : {table_bytes / mb:8.1f} Mo ({table_bytes / n:.0f} o/contact, build {table_s:.1f} s)")
+    print(f"réduction         : x{dict_bytes / table_bytes:.1f}")
+    print(f"balayage relances : {sweep_ms:.0f} ms ({len(due)} contacts dus)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Vérifie la sélection des sections du prompt (PromptIndex.select) sur des messages types.
+
+Chaque requête doit renvoyer un prompt contenant au moins les sections attendues
+(noyau compris). Une liste vide signifie « noyau seul » : aucune section
+supplémentaire ne doit être retenue (ex. remerciements). Code retour 1 en cas d'écart.
+
+    python check_prompt_retrieval.py
+    python check_prompt_retrieval.py -v
+"""
+import argparse
+import sys
+import tempfile
+
+from simulate_schedulers import import_model6
+
+OFFRE_SOL = "NOTRE OFFRE 1)"
+OFFRE_GAZON = "NOTRE OFFRE 2)"
+REGLES = "RÈGLES DE RECOMMANDATION"
+
+# message client -> préfixes des titres de section qui doivent figurer dans le prompt
+EXPECTED = [
+    ("Merci beaucoup !", []),
+    ("merci beaucoup", []),
+    ("Ok merci, bonne soirée", []),
+    ("Bonjour, j'ai un jardin de 200 m² à engazonner, que me conseillez-vous ?",
+     [OFFRE_GAZON, REGLES, "CALCULS À PRODUIRE"]),
+    ("j'ai 80 m2 au soleil, quel gazon ?", [OFFRE_GAZON, REGLES]),
+    ("je veux refaire ma pelouse de 150m2", [OFFRE_GAZON, REGLES]),
+    ("Bonjour", [OFFRE_SOL, OFFRE_GAZON, REGLES, "COORDONNÉES", "LIMITES"]),
+    ("Quel engrais pour 300 m2 ?", [OFFRE_GAZON, REGLES, "NOTRE OFFRE 3)"]),
+    ("Vous livrez à Marseille ?", [OFFRE_GAZON, REGLES, "NOTRE OFFRE 4)"]),
+    ("Combien coûte un devis, je veux commander", [OFFRE_GAZON, REGLES, "COORDONNÉES"]),
+    ("Mon terrain est très sec, il faut beaucoup d'eau ?", [OFFRE_SOL, "DIAGNOSTIC À POSER"]),
+]
+
+
+def check(index, user_text, expected):
+    """Écarts (sections manquantes, ou retenues en trop si `expected` est vide) + sections présentes."""
+    prompt, picked = index.select(user_text)
+    present = [title for title, text in index.sections if text in prompt]
+    if not expected:
+        return [f"+{title}" for title in picked], present, prompt
+    return [p for p in expected if not any(title.startswith(p) for title in present)], present, prompt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="affiche les sections retenues")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        model6 = import_model6(workdir)
+        index = model6.PromptIndex(model6.GAZONS_PROMPT)
+        failures = 0
+        for user_text, expected in EXPECTED:
+            errors, present, prompt = check(index, user_text, expected)
+            status = "OK  " if not errors else "FAIL"
+            failures += bool(errors)
+            print(f"{status} {user_text!r} ({model6.count_tokens(prompt)} tokens)"
+                  + (f" -> écarts {errors}" if errors else ""))
+            if args.verbose:
+                print(f"     sections : {[t or '(préambule)' for t in present]}")
+    print(f"{len(EXPECTED) - failures}/{len(EXPECTED)} requêtes conformes")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Table compacte de l'état des contacts (relances).
+
+Une ligne par contact, en colonnes : wa_id encodé en entier (array 'q'),
+dernier message client / bot en secondes epoch (array 'I', 0 = jamais) et
+drapeaux regroupés dans un bytearray. L'index wa_id -> ligne est une table de
+hachage à adressage ouvert (array 'i') : aucun objet Python par contact.
+Les wa_id non numériques (rares) passent par un dict de chaînes internées.
+
+Les lectures n'insèrent jamais de ligne ; le balayage des relances se fait sur
+les colonnes, avec numpy si disponible.
+"""
+import base64
+import sys
+import threading
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FOLLOWUP_SENT = 0x01   # relance déjà envoyée depuis le dernier message client
+BOT_REPLIED = 0x02     # le bot a répondu après le dernier message client
+
+_EMPTY = -1
+_MIN_SLOTS = 1024
+
+
+def _numeric_key(wa_id):
+    """wa_id (chiffres, sans zéro initial) -> int64 ; None sinon."""
+    if wa_id and wa_id.isascii() and wa_id.isdigit() and wa_id[0] != "0" and len(wa_id) <= 18:
+        return int(wa_id)
+    return None
+
+
+class ContactTable:
+    """wa_id -> ligne ; colonnes last_user / last_bot (secondes epoch) + drapeaux."""
+
+    def __init__(self):
+        self.keys = array("q")         # wa_id numérique, ou -1 (cf. self.other)
+        self.last_user = array("I")    # dernier message client (0 = aucun)
+        self.last_bot = array("I")     # dernière réponse / relance du bot (0 = aucune)
+        self.flags = bytearray()       # FOLLOWUP_SENT | BOT_REPLIED
+        self.slots = array("i", [_EMPTY]) * _MIN_SLOTS   # index : slot -> ligne
+        self.other = {}                # wa_id non numérique (interné) -> ligne
+        self.other_ids = {}            # ligne -> wa_id non numérique
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, wa_id):
+        return self.row(wa_id) is not None
+
+    # --- Index ---
+    def _slot(self, key, slots=None):
+        """Slot de `key` (ou premier slot libre) ; sondage linéaire, charge <= 1/2."""
+        slots = self.slots if slots is None else slots
+        keys = self.keys
+        mask = len(slots) - 1
+        i = ((key ^ (key >> 29)) * 0x9E3779B1) & mask
+        while True:
+            row = slots[i]
+            if row == _EMPTY or keys[row] == key:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        # Construit à part puis remplace : les lectures sans verrou voient un index complet
+        slots = array("i", [_EMPTY]) * (len(self.slots) * 2)
+        for row, key in enumerate(self.keys):
+            if key >= 0:
+                slots[self._slot(key, slots)] = row
+        self.slots = slots
+
+    def row(self, wa_id):
+        """N° de ligne du contact, ou None (sans insertion)."""
+        key = _numeric_key(wa_id)
+        if key is None:
+            return self.other.get(wa_id)
+        slots = self.slots   # une seule lecture : _grow() peut remplacer l'index entre-temps
+        row = slots[self._slot(key, slots)]
+        return None if row == _EMPTY else row
+
+    def _ensure(self, wa_id):
+        """N° de ligne du contact, créée si besoin (à appeler sous self.lock)."""
+        key = _numeric_key(wa_id)
+        if key is None:
+            row = self.other.get(wa_id)
+            if row is None:
+                row = len(self.keys)
+                wa_id = sys.intern(wa_id)
+                self.other[wa_id] = row
+                self.other_ids[row] = wa_id
+                self._append(-1)
+            return row
+        i = self._slot(key)
+        row = self.slots[i]
+        if row == _EMPTY:
+            row = len(self.keys)
+            self._append(key)
+            self.slots[i] = row
+            if len(self.keys) * 2 > len(self.slots):
+                self._grow()
+        return row
+
+    def _append(self, key):
+        self.keys.append(key)
+        self.last_user.append(0)
+        self.last_bot.append(0)
+        self.flags.append(0)
+
+    def wa_id(self, row):
+        key = self.keys[row]
+        return str(key) if key >= 0 else self.other_ids[row]
+
+    # --- Mutations ---
+    def touch_user(self, wa_id, at):
+        """Message client : horodate et réarme la relance."""
+        with self.lock:
+            row = self._ensure(wa_id)
+            self.last_user[row] = at
+            self.flags[row] &= ~(FOLLOWUP_SENT | BOT_REPLIED) & 0xFF
+
+    def touch_bot(self, wa_id, at, followup=False):
+        """Réponse du bot ; followup=True pour une relance."""
+        with self.lock:
+            row = self._ensure(wa_id)
+            self.last_bot[row] = at
+            self.flags[row] |= BOT_REPLIED | (FOLLOWUP_SENT if followup else 0)
+
+    # --- Lectures (sans insertion) ---
+    def last_user_at(self, wa_id):
+        row = self.row(wa_id)
+        return self.last_user[row] if row is not None else 0
+
+    def last_bot_at(self, wa_id):
+        row = self.row(wa_id)
+        return self.last_bot[row] if row is not None else 0
+
+    def followup_sent(self, wa_id):
+        row = self.row(wa_id)
+        return row is not None and bool(self.flags[row] & FOLLOWUP_SENT)
+
+    def count_followups_sent(self):
+        with self.lock:
+            if np is not None and self.flags:
+                return int(np.count_nonzero(np.frombuffer(self.flags, dtype=np.uint8) & FOLLOWUP_SENT))
+            return sum(1 for f in self.flags if f & FOLLOWUP_SENT)
+
+    # --- Balayage ---
+    def due_followups(self, now, silence, max_age):
+        """
+        wa_ids à relancer : silencieux depuis [silence, max_age] secondes, avec une réponse
+        du bot après leur dernier message, et pas encore relancés.
+        """
+        with self.lock:
+            n = len(self.keys)
+            if not n:
+                return []
+            lo, hi = max(0, now - max_age), max(0, now - silence)
+            if np is not None:
+                user = np.frombuffer(self.last_user, dtype=np.uint32, count=n)
+                flags = np.frombuffer(self.flags, dtype=np.uint8, count=n)
+                mask = ((user > 0) & (user >= lo) & (user <= hi)
+                        & ((flags & (FOLLOWUP_SENT | BOT_REPLIED)) == BOT_REPLIED))
+                rows = np.flatnonzero(mask).tolist()
+                del user, flags, mask   # libère les vues avant tout redimensionnement
+            else:
+                rows = [i for i, (u, f) in enumerate(zip(self.last_user, self.flags))
+                        if u and lo <= u <= hi and f & (FOLLOWUP_SENT | BOT_REPLIED) == BOT_REPLIED]
+            return [self.wa_id(i) for i in rows]
+
+    # --- Snapshot ---
+    def dump(self):
+        """Colonnes sérialisables (JSON) : tableaux binaires en base64, index compris."""
+        def b64(buf):
+            return base64.b64encode(bytes(buf)).decode()
+
+        with self.lock:
+            return {
+                "keys": b64(self.keys),
+                "last_user": b64(self.last_user),
+                "last_bot": b64(self.last_bot),
+                "flags": b64(self.flags),
+                "slots": b64(self.slots),
+                "other": {str(row): w for row, w in self.other_ids.items()},
+            }
+
+    def load(self, data):
+        """Remplace le contenu par un dump() : frombytes, sans objet par contact."""
+        def column(typecode, field):
+            col = array(typecode)
+            col.frombytes(base64.b64decode(data[field]))
+            return col
+
+        keys, slots = column("q", "keys"), column("i", "slots")
+        last_user, last_bot = column("I", "last_user"), column("I", "last_bot")
+        flags = bytearray(base64.b64decode(data["flags"]))
+        if not len(keys) == len(last_user) == len(last_bot) == len(flags):
+            raise ValueError("contact table snapshot: column length mismatch")
+        other_ids = {int(row): sys.intern(w) for row, w in data.get("other", {}).items()}
+        with self.lock:
+            self.keys, self.slots = keys, slots
+            self.last_user, self.last_bot, self.flags = last_user, last_bot, flags
+            self.other_ids = other_ids
+            self.other = {w: row for row, w in other_ids.items()}
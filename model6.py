@@ -2,49 +2,75 @@ import random
 import requests
 import json
 import os
+import sys
 import csv
+import re
+import math
+import unicodedata
+import hmac
+import hashlib
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from openai import OpenAI
+from requests.adapters import HTTPAdapter
 from collections import defaultdict
 from collections import deque
+from contact_state import ContactTable
 
+# Déduplication des message IDs (cf. remember_message, sous state_journal.lock)
 processed_message_ids = set()
-processed_order = deque(maxlen=2000)
+processed_order = deque()
+DEDUP_MAX = 5000    # au-delà, purge des plus anciens...
+DEDUP_KEEP = 4000   # ...jusqu'à ce nombre
 
 # Paramètre délai avant relance
 SILENCE_AFTER = timedelta(minutes=5)   # prod = 10 min ; pour test tu peux mettre 1
+FOLLOWUP_MAX_AGE = timedelta(hours=24)  # au-delà, fenêtre WhatsApp fermée : pas de relance
+PROMO_WEEKDAY = 4                       # vendredi (lundi = 0)
+PROMO_TIME = (20, 59)                   # heure locale d'envoi de la promo
+
+
+class SystemClock:
+    """Horloge réelle ; remplaçable par une horloge virtuelle (cf. simulate_schedulers.py)."""
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+clock = SystemClock()
 
 # =====================
 # Load Environment Vars
 # =====================
 load_dotenv()
 
-# Mémoire légère par contact (in-memory)
-last_user_at = defaultdict(lambda: None)    # dernière heure d’un message client
-last_bot_at = defaultdict(lambda: None)     # dernière heure d’un message IA
-followup_sent = defaultdict(lambda: False)  # relance déjà envoyée ?
-
 from pathlib import Path
 
-HISTORY_FILE = Path("chat_history.csv")
-HISTORY_FILE.touch(exist_ok=True)
-
-def append_history(wa_id: str, role: str, content: str) -> None:
+def append_history(wa_id: str, role: str, content: str, tenant=None) -> None:
     """Ajoute une ligne d'historique (wa_id, role=user/assistant, content, timestamp)."""
-    with HISTORY_FILE.open("a", newline="") as f:
+    tenant = tenant or DEFAULT_TENANT
+    with tenant.history_file.open("a", newline="") as f:
         w = csv.writer(f)
-        w.writerow([wa_id, role, content, datetime.utcnow().isoformat()])
+        w.writerow([wa_id, role, content, clock.utcnow().isoformat()])
 
-def read_history(wa_id: str, limit: int = 20):
+def read_history(wa_id: str, limit: int = 20, tenant=None):
     """Retourne les 'limit' derniers messages (role, content) pour ce wa_id."""
+    tenant = tenant or DEFAULT_TENANT
     rows = []
-    if not HISTORY_FILE.exists():
+    if not tenant.history_file.exists():
         return rows
-    with HISTORY_FILE.open("r", newline="") as f:
+    with tenant.history_file.open("r", newline="") as f:
         r = csv.reader(f)
         for row in r:
             if len(row) < 4:
@@ -58,6 +84,17 @@ def read_history(wa_id: str, limit: int = 20):
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")           # Meta Verify Token
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")       # Permanent WhatsApp token
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")     # WhatsApp Phone Number ID
+APP_SECRET = os.getenv("APP_SECRET", "")           # Meta App Secret (signature X-Hub-Signature-256)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")         # Jeton pour les routes d'admin (/stats, ...)
+# Sans APP_SECRET, les POST /webhook sont refusés (403) sauf opt-out explicite (dev local)
+ALLOW_UNSIGNED_WEBHOOKS = os.getenv("ALLOW_UNSIGNED_WEBHOOKS", "0") == "1"
+if not APP_SECRET:
+    if ALLOW_UNSIGNED_WEBHOOKS:
+        print("⚠️ APP_SECRET absent et ALLOW_UNSIGNED_WEBHOOKS=1 : signature X-Hub-Signature-256 "
+              "NON vérifiée, le webhook accepte n'importe quel POST", flush=True)
+    else:
+        print("⚠️ APP_SECRET absent : tous les POST /webhook seront refusés "
+              "(ALLOW_UNSIGNED_WEBHOOKS=1 pour accepter sans signature)", flush=True)
 
 # --- OpenAI client & modèle ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
@@ -72,6 +109,34 @@ MODEL_NAME = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 CHAT_CSV = "chat_history.csv"
 CUSTOMER_FILE = "customers.csv"
 
+# Promo personnalisée : textes pré-générés hors ligne (promo_batch.py), lus au moment de l'envoi
+PROMO_TEXTS_FILE = "promo_texts.jsonl"
+PROMO_TEXT_MAX_AGE = timedelta(days=int(os.getenv("PROMO_TEXT_MAX_AGE_DAYS", "7")))
+PROMO_TEMPLATE = os.getenv("PROMO_TEMPLATE", "weekly_promo")       # template avec 1 variable {{1}}
+PROMO_TEMPLATE_LANG = os.getenv("PROMO_TEMPLATE_LANG", "fr")
+
+# Multi-numéros : config des tenants (JSON) et dossier de stockage par namespace
+TENANTS_FILE = os.getenv("TENANTS_FILE", "tenants.json")
+# phone_number_id inconnu : ignoré (200) par défaut ; "1" = servi par le tenant par défaut
+UNKNOWN_TENANT_FALLBACK = os.getenv("UNKNOWN_TENANT_FALLBACK", "0") == "1"
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SEND_RATE_PER_SEC = float(os.getenv("SEND_RATE_PER_SEC", "20"))  # débit Graph max par numéro
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))          # connexions Graph par numéro
+
+# Admission : quota par contact + nb max d'appels LLM simultanés
+CONTACT_RATE_PER_MIN = float(os.getenv("CONTACT_RATE_PER_MIN", "6"))  # messages/min traités par contact
+CONTACT_BURST = float(os.getenv("CONTACT_BURST", "4"))                # rafale tolérée
+# WEB_THREADS doit valoir le --threads de gunicorn (le Procfile lit la même variable) :
+# au-delà, les requêtes attendent dans le backlog gunicorn, invisibles pour l'admission.
+# Par défaut : LLM_MAX_INFLIGHT threads en appel OpenAI, LLM_QUEUE_MAX en file, et au
+# moins un thread libre pour les statuts / GET ; au-delà de WEBHOOK_MAX_INFLIGHT
+# webhooks simultanés, réponse de repli immédiate pour vider le backlog.
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "4"))            # appels OpenAI en parallèle
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", str(max(1, WEB_THREADS - LLM_MAX_INFLIGHT - 1))))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", str(LLM_MAX_INFLIGHT + LLM_QUEUE_MAX)))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "5"))        # attente max d'un slot (s)
+
 # =====================
 # Flask + OpenAI
 # =====================
@@ -86,7 +151,6 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 # Memory (per user chat)
 # =====================
 conversations = defaultdict(list)  # { wa_id: [messages] }
-customers = set()  # unique customer IDs for promotions
 
 
 # =====================
@@ -126,110 +190,232 @@ def followup_worker():
     print(f"[config] SILENCE_AFTER={SILENCE_AFTER}, CHECK_EVERY={CHECK_EVERY}", flush=True)
 
     while True:
-        try:
-            now = datetime.utcnow()
-            for wa_id, last_user in list(last_user_at.items()):
-                if not last_user:
-                    print(f"[followup] skip {wa_id}: no last_user", flush=True)
-                    continue
+        run_followups()
 
-                if followup_sent.get(wa_id, False):
-                    print(f"[followup] skip {wa_id}: already sent", flush=True)
-                    continue
+        # Petit jitter pour éviter les envois trop synchronisés
+        clock.sleep(CHECK_EVERY + random.uniform(0, 2))
 
-                last_bot = last_bot_at.get(wa_id)
 
-                # Log des timestamps connus pour ce user
-                print(
-                    f"[followup] {wa_id}: last_user={last_user.isoformat()}, "
-                    f"last_bot={(last_bot.isoformat() if last_bot else None)}",
-                    flush=True
-                )
+FOLLOWUP_DEBUG = os.getenv("FOLLOWUP_DEBUG", "1") == "1"   # logs détaillés par contact
+
+
+def run_followups(now=None, send=None):
+    """Une passe de relance sur tous les tenants (cf. followup_tick). Renvoie le nb de relances."""
+    return sum(followup_tick(tenant, now=now, send=send) for tenant in list(TENANTS.values()))
 
-                # Le bot doit avoir répondu après le dernier message user
-                if not last_bot or last_bot <= last_user:
-                    print(
-                        f"[followup] skip {wa_id}: bot_not_after_user "
-                        f"(last_bot={last_bot}, last_user={last_user})",
-                        flush=True
-                    )
-                    continue
 
-                delta = now - last_user
-                # Log du delta et du seuil
+def followup_tick(tenant, now=None, send=None):
+    """
+    Une passe de relance sur les contacts d'un tenant. Renvoie le nb de relances envoyées.
+    `now` et `send` sont injectables (simulation à horloge virtuelle, faux envoi).
+    """
+    contacts = tenant.contacts
+    send = send or send_whatsapp_message
+    sent = 0
+    try:
+        now = now or clock.utcnow()
+        # Balayage vectoriel : silencieux depuis [SILENCE_AFTER, 24h], bot après le user, pas encore relancé
+        due = contacts.due_followups(
+            to_epoch(now),
+            int(SILENCE_AFTER.total_seconds()),
+            int(FOLLOWUP_MAX_AGE.total_seconds()),
+        )
+        for wa_id in due:
+            if FOLLOWUP_DEBUG:
                 print(
-                    f"[followup] {wa_id}: delta={delta}, threshold={SILENCE_AFTER}",
+                    f"[followup] {wa_id}: last_user={from_epoch(contacts.last_user_at(wa_id)).isoformat()}, "
+                    f"last_bot={from_epoch(contacts.last_bot_at(wa_id)).isoformat()}",
                     flush=True
                 )
+            print(f"[followup] SEND nudge to {wa_id}", flush=True)
+            try:
+                nudge = random.choice([
+                    "Souhaitez-vous que je vous aide à estimer la surface ou la livraison ?",
+                    "Je peux vous guider entre Elite et Water Saver si vous hésitez.",
+                    "Besoin d’un récap rapide sur l’entretien (arrosage, tonte, engrais) ?",
+                    "Je reste dispo si vous avez une question 🙂"
+                ])
+                send(wa_id, nudge, kind="nudge", tenant=tenant)
+                tenant.mark_bot(wa_id, now, followup=True)
+                sent += 1
+                print(f"[followup] sent to {wa_id}", flush=True)
+            except Exception as e:
+                print("followup send error:", e, flush=True)
 
-                if not (SILENCE_AFTER <= delta <= timedelta(hours=24)):
-                    print(
-                        f"[followup] wait {wa_id}: delta={delta}, "
-                        f"window=({SILENCE_AFTER}, 24h)",
-                        flush=True
-                    )
-                    continue
-
-                print(f"[followup] SEND nudge to {wa_id} (delta={delta})", flush=True)
-                try:
-                    nudge = random.choice([
-                        "Souhaitez-vous que je vous aide à estimer la surface ou la livraison ?",
-                        "Je peux vous guider entre Elite et Water Saver si vous hésitez.",
-                        "Besoin d’un récap rapide sur l’entretien (arrosage, tonte, engrais) ?",
-                        "Je reste dispo si vous avez une question 🙂"
-                    ])
-                    send_whatsapp_message(wa_id, nudge)
-                    followup_sent[wa_id] = True
-                    last_bot_at[wa_id] = now
-                    print(f"[followup] sent to {wa_id}", flush=True)
-                except Exception as e:
-                    print("followup send error:", e, flush=True)
-
-            # Résumé d’itération
+        # Résumé d’itération
+        if FOLLOWUP_DEBUG or sent:
             print(
-                f"[followup] loop: users={len(last_user_at)}, "
-                f"sent_flags={sum(1 for v in followup_sent.values() if v)}",
+                f"[followup] loop[{tenant.name}]: users={len(contacts)}, due={len(due)}, sent={sent}, "
+                f"sent_flags={contacts.count_followups_sent()}",
                 flush=True
             )
 
-        except Exception as e:
-            print("followup worker error:", e, flush=True)
-
-        # Petit jitter pour éviter les envois trop synchronisés
-        time.sleep(CHECK_EVERY + random.uniform(0, 2))
+    except Exception as e:
+        print("followup worker error:", e, flush=True)
+    return sent
 
 
 # =====================
 # Customer Management
 # =====================
-def load_customers():
+def load_customers(tenant):
     """Load customers from file"""
-    if os.path.exists(CUSTOMER_FILE):
-        with open(CUSTOMER_FILE, "r", encoding="utf-8") as f:
+    if tenant.customer_file.exists():
+        with tenant.customer_file.open("r", encoding="utf-8") as f:
             for line in f:
                 number = line.strip()
                 if number:
-                    customers.add(number)
+                    tenant.customers.add(number)
 
-def save_customer(wa_id):
+def save_customer(wa_id, tenant=None):
     """Add new customer to file if not already saved"""
-    if wa_id not in customers:
-        customers.add(wa_id)
-        with open(CUSTOMER_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{wa_id}\n")
+    tenant = tenant or DEFAULT_TENANT
+    with tenant.customer_lock:
+        if wa_id not in tenant.customers:
+            tenant.customers.add(wa_id)
+            with tenant.customer_file.open("a", encoding="utf-8") as f:
+                f.write(f"{wa_id}\n")
+
+
+# =====================
+# Delivery Status (sent / delivered / read / failed)
+# =====================
+STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+STATUS_FLUSH_AT = 200          # nb de statuts en attente avant application du lot
+DELIVERY_MAX_TRACKED = 50000   # nb max de message IDs conservés (les plus anciens sortent)
+FAILED_SKIP_AFTER = int(os.getenv("FAILED_SKIP_AFTER", "3"))  # échecs consécutifs avant exclusion promo
 
-# Load customers on startup
-load_customers()
+
+class DeliveryStore:
+    """
+    État de livraison compact par message ID sortant : [kind, wa_id, rang du statut].
+    Les callbacks sont empilés sans verrou puis appliqués par lots (flush).
+    Les échecs consécutifs sont comptés par (tenant, wa_id) : un numéro injoignable
+    depuis une ligne ne l'est pas forcément depuis une autre.
+    """
+
+    def __init__(self, max_tracked=DELIVERY_MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self.pending = deque()   # (msg_id, status, wa_id, tenant_key) pas encore appliqués
+        self.messages = {}       # msg_id -> [kind, wa_id, rank] (ordre d'insertion = ancienneté)
+        self.fail_streak = {}    # (tenant_key, wa_id) -> nb d'échecs consécutifs
+        self.lock = threading.Lock()
+
+    def _prune(self):
+        while len(self.messages) > self.max_tracked:
+            self.messages.pop(next(iter(self.messages)))
+
+    def track(self, msg_id, wa_id, kind):
+        """Enregistre un message sortant (reply / nudge / promo) pour suivre sa livraison."""
+        if not msg_id:
+            return
+        with self.lock:
+            rec = self.messages.get(msg_id)
+            if rec is None:
+                self.messages[msg_id] = [kind, wa_id, 0]
+                self._prune()
+            else:
+                # Le statut est parfois arrivé avant la réponse de l'API Graph
+                rec[0] = kind
+
+    def push(self, statuses):
+        """Empile les statuts reçus ; coût O(1) côté webhook, application par lots."""
+        self.pending.extend(statuses)
+        if len(self.pending) >= STATUS_FLUSH_AT:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            while self.pending:
+                msg_id, status, wa_id, tenant_key = self.pending.popleft()
+                rank = STATUS_RANK.get(status, 0)
+                rec = self.messages.get(msg_id)
+                if rec is None:
+                    rec = self.messages[msg_id] = [None, wa_id, 0]
+                if rank > rec[2]:
+                    rec[2] = rank
+                if rec[0] is None:
+                    continue  # message jamais envoyé par nous : pas d'effet sur fail_streak
+                key = (tenant_key, rec[1])   # destinataire de notre envoi, pas celui du payload
+                if status == "failed":
+                    self.fail_streak[key] = self.fail_streak.get(key, 0) + 1
+                elif status in ("delivered", "read"):
+                    self.fail_streak.pop(key, None)
+            self._prune()
+
+    def should_skip(self, tenant_key, wa_id):
+        """True si ce numéro échoue systématiquement depuis ce tenant (à exclure des envois de masse)."""
+        return self.fail_streak.get((tenant_key, wa_id), 0) >= FAILED_SKIP_AFTER
+
+    def report(self):
+        """Taux de livraison / lecture par type de message (reply, nudge, promo)."""
+        self.flush()
+        counts = defaultdict(lambda: {"sent": 0, "delivered": 0, "read": 0, "failed": 0})
+        with self.lock:
+            for kind, _wa_id, rank in self.messages.values():
+                if kind is None:
+                    continue
+                c = counts[kind]
+                c["sent"] += 1
+                if rank == STATUS_RANK["failed"]:
+                    c["failed"] += 1
+                elif rank >= STATUS_RANK["delivered"]:
+                    c["delivered"] += 1
+                    if rank == STATUS_RANK["read"]:
+                        c["read"] += 1
+        for c in counts.values():
+            c["delivered_rate"] = round(c["delivered"] / c["sent"], 3)
+            c["read_rate"] = round(c["read"] / c["sent"], 3)
+        return dict(counts)
+
+
+delivery_store = DeliveryStore()
+
+
+def extract_statuses(raw):
+    """Extrait (msg_id, status, recipient_id, phone_number_id) d'un payload de statuts Meta."""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return []
+    out = []
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            pid = str((value.get("metadata") or {}).get("phone_number_id") or "")
+            for st in value.get("statuses") or []:
+                out.append((st.get("id"), st.get("status"), st.get("recipient_id"), pid))
+    return out
+
+
+def verify_signature(raw, header):
+    """
+    Vérifie X-Hub-Signature-256 (HMAC-SHA256 du corps brut). Sans APP_SECRET,
+    refuse tout sauf si ALLOW_UNSIGNED_WEBHOOKS=1.
+    """
+    if not APP_SECRET:
+        return ALLOW_UNSIGNED_WEBHOOKS
+    if not header or not header.startswith("sha256="):
+        return False
+    expected = hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len("sha256="):])
+
+
+def is_admin(req):
+    """Autorise les routes d'admin via l'en-tête X-Admin-Token (refus si ADMIN_TOKEN non défini)."""
+    token = req.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
 
 
 # =====================
 # WhatsApp Messaging
 # =====================
-def send_whatsapp_message(wa_id, text):
+def send_whatsapp_message(wa_id, text, kind="reply", tenant=None):
     """Send a WhatsApp message. Fallback to template if >24h window closed."""
-    url = f"https://graph.facebook.com/v23.0/{PHONE_NUMBER_ID}/messages"
+    tenant = tenant or DEFAULT_TENANT
+    url = f"https://graph.facebook.com/v23.0/{tenant.phone_number_id}/messages"
     headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+        "Authorization": f"Bearer {tenant.token}",
         "Content-Type": "application/json"
     }
 
@@ -241,29 +427,80 @@ def send_whatsapp_message(wa_id, text):
         "text": {"body": text}
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
+    tenant.send_bucket.take()
+    response = tenant.session.post(url, headers=headers, data=json.dumps(payload))
     result = response.json()
     print("WA send status:", response.status_code, response.text, flush=True)
+    delivery_store.track((result.get("messages") or [{}])[0].get("id"), wa_id, kind)
 
     # Amorcer un suivi même en outbound-first
-    if wa_id not in last_user_at or last_user_at[wa_id] is None:
-        last_user_at[wa_id] = datetime.utcnow()
-        followup_sent[wa_id] = False
-        print(f"[followup] outbound-first init for {wa_id} at {last_user_at[wa_id].isoformat()}", flush=True)
+    if not tenant.contacts.last_user_at(wa_id):
+        now = clock.utcnow()
+        tenant.mark_user(wa_id, now)
+        print(f"[followup] outbound-first init for {wa_id} at {now.isoformat()}", flush=True)
 
     # ✅ If 24h window expired, send template instead
 
 
+# Accusé de lecture + indicateur "en train d'écrire", hors du chemin de réponse
+feedback_pool = ThreadPoolExecutor(max_workers=int(os.getenv("FEEDBACK_WORKERS", "4")),
+                                   thread_name_prefix="feedback")
+feedback_latency_ms = deque(maxlen=1000)   # réception -> premier retour visible (ms) ; append atomique
+
+
+def send_read_and_typing(tenant, msg_id, received_at, typing=True):
+    """
+    Marque le message comme lu et affiche l'indicateur de saisie (un seul appel Graph).
+    typing=False : accusé de lecture seul, quand aucune réponse ne suivra.
+    """
+    url = f"https://graph.facebook.com/v23.0/{tenant.phone_number_id}/messages"
+    headers = {
+        "Authorization": f"Bearer {tenant.token}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": msg_id,
+    }
+    if typing:
+        payload["typing_indicator"] = {"type": "text"}
+    try:
+        response = tenant.session.post(url, headers=headers, data=json.dumps(payload), timeout=5)
+        if response.ok:
+            feedback_latency_ms.append((time.perf_counter() - received_at) * 1000)
+        else:
+            print("read/typing status:", response.status_code, response.text, flush=True)
+    except Exception as e:
+        print("read/typing error:", e, flush=True)
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Percentiles simples (rang le plus proche) d'une série de latences."""
+    data = sorted(values)
+    if not data:
+        return {}
+    out = {f"p{p}": round(data[min(len(data) - 1, int(len(data) * p / 100))], 1) for p in points}
+    out["max"] = round(data[-1], 1)
+    out["count"] = len(data)
+    return out
+
+
 
 
 # --- Flask app ---
 app = Flask(__name__)
 
-def send_promo_template(wa_id):
-    """Always send the weekly_promo template for promotions"""
-    url = f"https://graph.facebook.com/v23.0/{PHONE_NUMBER_ID}/messages"
+def send_promo_template(wa_id, tenant=None, text=None):
+    """
+    Send the weekly_promo template ({{1}} = personalised text), or hello_world if no text.
+    If Graph rejects the personalised template (missing, unapproved, bad parameter),
+    the customer still gets hello_world.
+    """
+    tenant = tenant or DEFAULT_TENANT
+    url = f"https://graph.facebook.com/v23.0/{tenant.phone_number_id}/messages"
     headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
+        "Authorization": f"Bearer {tenant.token}",
         "Content-Type": "application/json"
     }
 
@@ -276,10 +513,27 @@ def send_promo_template(wa_id):
             "language": {"code": "en_US"}  # 👈 must match template language
         }
     }
+    personalised_payload = {
+        **template_payload,
+        "template": {
+            "name": PROMO_TEMPLATE,
+            "language": {"code": PROMO_TEMPLATE_LANG},
+            "components": [{"type": "body", "parameters": [{"type": "text", "text": text}]}]
+        }
+    }
 
-    response = requests.post(url, headers=headers, data=json.dumps(template_payload))
-    result = response.json()
+    def post(payload):
+        tenant.send_bucket.take()
+        response = tenant.session.post(url, headers=headers, data=json.dumps(payload))
+        return response.json()
+
+    result = post(personalised_payload if text else template_payload)
+    if text and result.get("error"):
+        print(f"⚠️ Promo template {PROMO_TEMPLATE!r} rejected for {wa_id}: {result['error']} "
+              f"-> fallback hello_world", flush=True)
+        result = post(template_payload)
     print(f"📤 Promo API response for {wa_id}:", result)
+    delivery_store.track((result.get("messages") or [{}])[0].get("id"), wa_id, "promo")
     return result
 
 
@@ -287,29 +541,79 @@ def send_promo_template(wa_id):
 # Promotion Scheduler
 # =====================
 last_promo_date = None
+next_promo_at = None   # prochain créneau promo (calculé au premier promotion_tick)
+
+def next_promo_run(now):
+    """Prochain créneau promo (vendredi 20:59, heure locale) strictement après `now`."""
+    days_ahead = (PROMO_WEEKDAY - now.weekday()) % 7   # every Friday
+    next_run = now + timedelta(days=days_ahead)
+    next_run = next_run.replace(hour=PROMO_TIME[0], minute=PROMO_TIME[1], second=0, microsecond=0)
+
+    if next_run <= now:
+        next_run += timedelta(days=7)
+    return next_run
+
+
+def load_promo_texts(tenant):
+    """Derniers textes promo pré-générés par wa_id (moins de PROMO_TEXT_MAX_AGE)."""
+    texts = {}
+    if not tenant.promo_file.exists():
+        return texts
+    cutoff = (clock.utcnow() - PROMO_TEXT_MAX_AGE).isoformat()
+    with tenant.promo_file.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # ligne tronquée (job interrompu)
+            if rec.get("text") and rec.get("generated_at", "") >= cutoff:
+                texts[rec["wa_id"]] = rec["text"]
+    return texts
+
+
+def run_promo_broadcast(send=None):
+    """Envoie la promo à tous les clients de tous les tenants. Renvoie le nb d'envois."""
+    send = send or send_promo_template
+    sent = 0
+    print("📊 Delivery report:", delivery_store.report(), flush=True)
+    print("🚀 Sending weekly promo template...")
+    for tenant in list(TENANTS.values()):
+        texts = load_promo_texts(tenant)
+        print(f"[promo] {tenant.name}: {len(texts)} textes personnalisés / {len(tenant.customers)} clients",
+              flush=True)
+        for wa_id in list(tenant.customers):
+            if delivery_store.should_skip(tenant.key, wa_id):
+                print(f"⏭️ Promo skipped for {wa_id} (échecs répétés)", flush=True)
+                continue
+            send(wa_id, tenant=tenant, text=texts.get(wa_id))
+            sent += 1
+    return sent
 
-def promotion_worker():
-    global last_promo_date
-    while True:
-        now = datetime.now()
-        days_ahead = (5 - now.weekday()) % 7   # every Friday
-        next_run = now + timedelta(days=days_ahead)
-        next_run = next_run.replace(hour=20, minute=59, second=0, microsecond=0)
-
-        if next_run <= now:
-            next_run += timedelta(days=7)
-
-        wait_time = (next_run - now).total_seconds()
-        time.sleep(wait_time)
 
-        if last_promo_date == next_run.date():
-            continue  # already sent today
+def promotion_tick(now=None, send=None):
+    """
+    Lance la promo si le créneau est atteint, une seule fois par date. Renvoie le nb d'envois.
+    `now` et `send` sont injectables (simulation à horloge virtuelle, faux envoi).
+    """
+    global last_promo_date, next_promo_at
+    now = now or clock.now()
+    if next_promo_at is None:
+        next_promo_at = next_promo_run(now)
+    if now < next_promo_at:
+        return 0
+    run_at, next_promo_at = next_promo_at, next_promo_run(now)
+    if last_promo_date == run_at.date():
+        return 0  # already sent today
+    sent = run_promo_broadcast(send=send)
+    last_promo_date = run_at.date()
+    return sent
 
-        print("🚀 Sending weekly promo template...")
-        for wa_id in customers:
-            send_promo_template(wa_id)
 
-        last_promo_date = next_run.date()
+def promotion_worker():
+    while True:
+        promotion_tick()
+        # Dort jusqu'au prochain créneau (au moins 1 s si le réveil est un peu en avance)
+        clock.sleep(max(1.0, (next_promo_at - clock.now()).total_seconds()))
 
 # --- Démarre le worker une seule fois (compatible Render/Gunicorn) ---
 try:
@@ -391,24 +695,675 @@ Donner au client le sentiment d’échanger avec un conseiller dédié, fiable e
 """
 
 
+# =====================
+# Prompt Retrieval (sections pertinentes seulement)
+# =====================
+PROMPT_RETRIEVAL = os.getenv("PROMPT_RETRIEVAL", "1") == "1"
+PROMPT_MAX_SECTIONS = int(os.getenv("PROMPT_MAX_SECTIONS", "3"))
+PROMPT_MIN_SCORE = float(os.getenv("PROMPT_MIN_SCORE", "0.08"))
+# Sections toujours envoyées : persona, objectifs, préparation du sol (Mélange Terre
+# Compost, recommandé systématiquement), offre gazon (deux alternatives), règles de
+# recommandation, coordonnées, style, limites
+CORE_SECTIONS = ("OBJECTIF", "NOTRE OFFRE 1)", "NOTRE OFFRE 2)", "RÈGLES DE RECOMMANDATION",
+                 "COORDONNÉES", "STYLE", "LIMITES")
+
+STOPWORDS = set("""
+les des une un le la de du et en au aux pour par sur avec dans est sont que qui quoi
+vous nous votre vos notre nos ce cet cette ces pas plus tres bien merci bonjour
+mon ma mes son sa ses ou mais donc car comme aussi tout tous faire fait peut
+""".split())
+
+# Expansion de requête : formulations client -> vocabulaire du prompt
+# (ancrées sur les mots : "eau" ne doit pas matcher "beaucoup", ni "sec" "secteur")
+QUERY_ALIASES = [
+    (re.compile(r"\d+\s*m\s*(²|2)(?!\w)|\bm2\b|\bm[eè]tres?\b", re.I), "surface zones"),
+    (re.compile(r"\bprix\b|\btarifs?\b|\bdevis\b|\bcommand|\bachet|\bcontact", re.I), "devis commande"),
+    (re.compile(r"\bs[eè]che?s?\b|\bs[eé]cheresse|\beau\b|\barros", re.I), "arrosage sécheresse"),
+    (re.compile(r"\bgraines?\b|\bsemer\b|\bsemis\b", re.I), "semis semences"),
+    (re.compile(r"\blivr|\btransport|\bexp[eé]di", re.I), "livraison"),
+]
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(text):
+        return len(_encoding.encode(text))
+except ImportError:
+    def count_tokens(text):
+        """Estimation (~4 caractères par token) si tiktoken n'est pas installé."""
+        return (len(text) + 3) // 4
+
+
+def _terms(text):
+    """Tokenise : minuscules, sans accents, sans mots vides, racine tronquée à 5 lettres."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [w[:5] for w in re.findall(r"[a-z]{3,}", text) if w not in STOPWORDS]
+
+
+def split_prompt(prompt):
+    """
+    Découpe un prompt en sections (titre en MAJUSCULES, sous-points "1) ...").
+    Renvoie [(titre, texte)] dans l'ordre ; le préambule a le titre "".
+    """
+    sections = [["", []]]
+    parent = ""
+    for line in prompt.strip().splitlines():
+        head = line.split("(")[0].strip()
+        if head and head == head.upper() and any(c.isalpha() for c in head) and not head.startswith(("-", "•")):
+            parent = head
+            sections.append([head, [line]])
+        elif re.match(r"^\d+\)\s", line):
+            if sections[-1][0] == parent and len(sections[-1][1]) == 1:
+                sections.pop()  # titre seul : porté par chaque sous-point
+            sections.append([f"{parent} {line.split(':')[0].strip()}", [line]])
+        else:
+            sections[-1][1].append(line)
+    return [(title, "\n".join(lines).strip()) for title, lines in sections if "\n".join(lines).strip()]
+
+
+class PromptIndex:
+    """Index TF-IDF local des sections d'un prompt système."""
+
+    def __init__(self, prompt):
+        self.full = prompt
+        self.full_tokens = count_tokens(prompt)
+        self.sections = split_prompt(prompt)
+        self.core = [i for i, (title, _) in enumerate(self.sections)
+                     if not title or title.startswith(CORE_SECTIONS)]
+        docs = [_terms(f"{title} {text}") for title, text in self.sections]
+        df = defaultdict(int)
+        for terms in docs:
+            for t in set(terms):
+                df[t] += 1
+        n = len(docs)
+        self.idf = {t: math.log((1 + n) / (1 + c)) + 1 for t, c in df.items()}
+        self.vectors = [self._vector(terms) for terms in docs]
+
+    def _vector(self, terms, weight=1.0, into=None):
+        vec = into if into is not None else defaultdict(float)
+        for t in terms:
+            if t in self.idf:
+                vec[t] += weight * self.idf[t]
+        return vec
+
+    @staticmethod
+    def _norm(vec):
+        return math.sqrt(sum(v * v for v in vec.values())) or 1.0
+
+    def select(self, user_text, recent=()):
+        """
+        Prompt réduit : sections du noyau + sections les plus proches du message
+        (et, avec un poids moindre, des derniers messages). Renvoie (prompt, titres retenus).
+        """
+        def expand(text):
+            extra = " ".join(alias for pattern, alias in QUERY_ALIASES if pattern.search(text))
+            return _terms(f"{text} {extra}")
+
+        query = self._vector(expand(user_text))
+        for past in recent:
+            self._vector(expand(past), weight=0.5, into=query)
+        qnorm = self._norm(query)
+
+        scored = []
+        for i, vec in enumerate(self.vectors):
+            if i in self.core or not query:
+                continue
+            score = sum(w * vec.get(t, 0.0) for t, w in query.items()) / (qnorm * self._norm(vec))
+            if score >= PROMPT_MIN_SCORE:
+                scored.append((score, i))
+        picked = {i for _, i in sorted(scored, reverse=True)[:PROMPT_MAX_SECTIONS]}
+
+        keep = [i for i in range(len(self.sections)) if i in picked or i in self.core]
+        prompt = "\n\n".join(self.sections[i][1] for i in keep)
+        return prompt, [self.sections[i][0] for i in keep if i in picked]
+
+
+# Tokens du prompt système : envoyés vs prompt complet (cumul depuis le démarrage)
+prompt_stats = {"requests": 0, "full_tokens": 0, "sent_tokens": 0, "usage_prompt_tokens": 0}
+prompt_stats_lock = threading.Lock()   # += n'est pas atomique entre threads gunicorn
+
+
+def build_system_prompt(tenant, user_text, past):
+    """Prompt système du tenant, réduit aux sections utiles si PROMPT_RETRIEVAL est actif."""
+    index = tenant.prompt_index
+    if not PROMPT_RETRIEVAL:
+        prompt, picked = index.full, ["*"]
+    else:
+        recent = [m["content"] for m in past[-4:] if m.get("role") == "user"]
+        prompt, picked = index.select(user_text, recent)
+    sent = count_tokens(prompt)
+    with prompt_stats_lock:
+        prompt_stats["requests"] += 1
+        prompt_stats["full_tokens"] += index.full_tokens
+        prompt_stats["sent_tokens"] += sent
+    print(f"[prompt] system tokens full={index.full_tokens} sent={sent} sections={picked}", flush=True)
+    return prompt
+
+
+# =====================
+# Tenants (plusieurs numéros WhatsApp dans un seul process)
+# =====================
+class TokenBucket:
+    """Seau à jetons thread-safe : `rate` jetons/seconde, capacité `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        """Prend n jetons si disponibles, sans attendre."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n:
+                self.tokens -= n
+                return True
+            return False
+
+    def take(self, n=1):
+        """Prend n jetons, en attendant qu'ils soient disponibles."""
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Tenant:
+    """
+    Un numéro WhatsApp (phone_number_id) : token, prompt, pool HTTP Graph,
+    débit d'envoi, fichiers (namespace) et état des contacts qui lui sont propres.
+    """
+
+    def __init__(self, phone_number_id, token, prompt, namespace="", name=None,
+                 send_rate=SEND_RATE_PER_SEC, pool_size=HTTP_POOL_SIZE,
+                 contact_rate_per_min=CONTACT_RATE_PER_MIN, contact_burst=CONTACT_BURST):
+        self.phone_number_id = phone_number_id
+        self.key = str(phone_number_id)   # identifiant dans le journal / snapshot d'état
+        self.token = token
+        self.prompt = prompt
+        self.prompt_index = PromptIndex(prompt)
+        self.namespace = namespace
+        self.name = name or namespace or "default"
+
+        # Stockage : le tenant par défaut garde les fichiers historiques à la racine
+        base = Path(DATA_DIR) / namespace if namespace else Path(".")
+        base.mkdir(parents=True, exist_ok=True)
+        self.history_file = base / CHAT_CSV
+        self.customer_file = base / CUSTOMER_FILE
+        self.promo_file = base / PROMO_TEXTS_FILE
+        self.history_file.touch(exist_ok=True)
+
+        # Mémoire légère par contact (in-memory)
+        self.customers = set()                          # unique customer IDs for promotions
+        self.contacts = ContactTable()                  # dernier msg client / IA, relance envoyée
+
+        # Pool de connexions Graph dédié + débit d'envoi propre au numéro
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.send_bucket = TokenBucket(send_rate)
+
+        # Quota de messages entrants par contact
+        self.contact_rate = contact_rate_per_min / 60.0
+        self.contact_burst = contact_burst
+        self.contact_buckets = {}     # wa_id -> TokenBucket
+        self.contact_held = set()     # contacts ayant déjà reçu le message d'attente
+        self.contact_lock = threading.Lock()   # contact_buckets + contact_held
+        self.customer_lock = threading.Lock()  # customers + customer_file (save_customer)
+
+        load_customers(self)
+
+    def admit_contact(self, wa_id):
+        """True si le contact a encore du quota ; les seaux inactifs (pleins) sont purgés."""
+        with self.contact_lock:
+            bucket = self.contact_buckets.get(wa_id)
+            if bucket is None:
+                if len(self.contact_buckets) >= 10000:
+                    idle = time.monotonic() - self.contact_burst / self.contact_rate
+                    self.contact_buckets = {k: b for k, b in self.contact_buckets.items() if b.updated > idle}
+                bucket = self.contact_buckets[wa_id] = TokenBucket(self.contact_rate, self.contact_burst)
+        return bucket.try_take()
+
+    # Mutations de l'état de relance : mémoire + journal (cf. StateJournal)
+    def mark_user(self, wa_id, at):
+        """Message client reçu (ou premier envoi sortant) : relance réarmée."""
+        with state_journal.lock:
+            self.contacts.touch_user(wa_id, to_epoch(at))
+            state_journal.write("u", self.key, wa_id, to_epoch(at))
+
+    def mark_bot(self, wa_id, at, followup=False):
+        """Réponse du bot (ou relance si followup=True)."""
+        with state_journal.lock:
+            self.contacts.touch_bot(wa_id, to_epoch(at), followup=followup)
+            state_journal.write("f" if followup else "b", self.key, wa_id, to_epoch(at))
+
+
+def load_tenants():
+    """
+    Tenant par défaut depuis .env (PHONE_NUMBER_ID / WHATSAPP_TOKEN / GAZONS_PROMPT),
+    puis tenants additionnels depuis TENANTS_FILE, ex. :
+    [{"phone_number_id": "...", "token_env": "WHATSAPP_TOKEN_B", "prompt_file": "prompt_b.txt",
+      "namespace": "b", "name": "Ligne B", "send_rate": 20}]
+    """
+    default = Tenant(PHONE_NUMBER_ID, WHATSAPP_TOKEN, GAZONS_PROMPT)
+    tenants = {PHONE_NUMBER_ID: default}
+
+    if os.path.exists(TENANTS_FILE):
+        with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+        for cfg in configs:
+            pid = str(cfg["phone_number_id"])
+            prompt = GAZONS_PROMPT
+            if cfg.get("prompt_file"):
+                with open(cfg["prompt_file"], "r", encoding="utf-8") as pf:
+                    prompt = pf.read()
+            token = cfg.get("token") or os.getenv(cfg.get("token_env", ""), "") or WHATSAPP_TOKEN
+            namespace = cfg.get("namespace", "") if pid == PHONE_NUMBER_ID else cfg.get("namespace") or pid
+            tenants[pid] = Tenant(
+                pid, token, prompt,
+                namespace=namespace,
+                name=cfg.get("name"),
+                send_rate=float(cfg.get("send_rate", SEND_RATE_PER_SEC)),
+                pool_size=int(cfg.get("pool_size", HTTP_POOL_SIZE)),
+                contact_rate_per_min=float(cfg.get("contact_rate_per_min", CONTACT_RATE_PER_MIN)),
+                contact_burst=float(cfg.get("contact_burst", CONTACT_BURST)),
+            )
+            if pid == PHONE_NUMBER_ID:
+                default = tenants[pid]
+
+    print(f"[tenants] {len(tenants)} numéro(s): {[t.name for t in tenants.values()]}", flush=True)
+    return tenants, default
+
+
+TENANTS, DEFAULT_TENANT = load_tenants()
+
+
+def get_tenant(phone_number_id):
+    """
+    Tenant correspondant à metadata.phone_number_id ; None si inconnu ou absent,
+    sauf si UNKNOWN_TENANT_FALLBACK=1 (tenant par défaut).
+    """
+    tenant = TENANTS.get(str(phone_number_id or ""))
+    if tenant is None and UNKNOWN_TENANT_FALLBACK:
+        return DEFAULT_TENANT
+    return tenant
+
+
+# =====================
+# State Persistence (snapshot + journal, reprise rapide au redémarrage)
+# =====================
+STATE_DIR = Path(os.getenv("STATE_DIR", DATA_DIR)).resolve()
+SNAPSHOT_FILE = STATE_DIR / "state.snapshot.json"
+SNAPSHOT_EVERY = float(os.getenv("SNAPSHOT_EVERY", "300"))                 # secondes
+SNAPSHOT_EVERY_EVENTS = int(os.getenv("SNAPSHOT_EVERY_EVENTS", "20000"))   # lignes de journal
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(dt):
+    """datetime UTC naïf -> secondes epoch (int)."""
+    return (dt - _EPOCH) // timedelta(seconds=1)
+
+
+def from_epoch(seconds):
+    return _EPOCH + timedelta(seconds=seconds)
+
+
+class StateJournal:
+    """
+    Journal append-only des mutations d'état (u/b/f par contact, m pour la déduplication),
+    découpé en générations : un snapshot de génération G + les journaux >= G suffisent
+    à reconstruire l'état, sans relire chat_history.csv.
+    """
+
+    def __init__(self, directory):
+        self.dir = directory
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.snapshot_lock = threading.Lock()   # un seul snapshot à la fois
+        self.gen = 0
+        self.fh = None
+        self.events = 0
+        self.last_snapshot = time.monotonic()
+        self.snapshotting = False
+
+    def path(self, gen):
+        return self.dir / f"state.journal.{gen}"
+
+    def generations(self):
+        gens = []
+        for p in self.dir.glob("state.journal.*"):
+            suffix = p.name.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                gens.append(int(suffix))
+        return sorted(gens)
+
+    def open(self, gen):
+        if self.fh:
+            self.fh.close()
+        self.gen = gen
+        self.fh = open(self.path(gen), "a", encoding="utf-8")
+        self.events = 0
+
+    def write(self, *fields):
+        with self.lock:
+            if self.fh is None:
+                return
+            self.fh.write("\t".join(str(f) for f in fields) + "\n")
+            self.fh.flush()
+            self.events += 1
+            due = (self.events >= SNAPSHOT_EVERY_EVENTS
+                   or time.monotonic() - self.last_snapshot >= SNAPSHOT_EVERY)
+            if due and not self.snapshotting:
+                self.snapshotting = True
+                threading.Thread(target=self.snapshot, daemon=True, name="snapshot").start()
+
+    def capture(self):
+        """Copie compacte de l'état (epochs) ; à appeler sous self.lock."""
+        contacts = {t.key: t.contacts.dump() for t in TENANTS.values()}
+        return {"version": 2, "contacts": contacts, "dedup": list(processed_order)}
+
+    def snapshot(self):
+        """Fige l'état, bascule sur une nouvelle génération de journal, écrit le snapshot."""
+        try:
+            with self.snapshot_lock:
+                with self.lock:
+                    state = self.capture()
+                    self.open(self.gen + 1)
+                    state["gen"] = self.gen
+                    state["at"] = to_epoch(clock.utcnow())
+                tmp = SNAPSHOT_FILE.with_suffix(".tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state, f, separators=(",", ":"))
+                os.replace(tmp, SNAPSHOT_FILE)
+                for gen in self.generations():
+                    if gen < state["gen"]:
+                        self.path(gen).unlink(missing_ok=True)
+            print(f"[state] snapshot gen={state['gen']} written", flush=True)
+        except Exception as e:
+            print("state snapshot error:", e, flush=True)
+        finally:
+            self.last_snapshot = time.monotonic()
+            self.snapshotting = False
+
+    def restore(self):
+        """Charge le dernier snapshot puis rejoue la fin du journal ; ouvre une nouvelle génération."""
+        t0 = time.perf_counter()
+        by_key = {t.key: t for t in TENANTS.values()}
+        snap_gen, replayed = 0, 0
+        if SNAPSHOT_FILE.exists():
+            with open(SNAPSHOT_FILE, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") != 2:
+                raise ValueError(f"state snapshot: unsupported version {state.get('version')!r}")
+            snap_gen = state.get("gen", 0)
+            for key, data in state.get("contacts", {}).items():
+                if key in by_key:
+                    by_key[key].contacts.load(data)
+            for msg_id in state.get("dedup", []):
+                processed_message_ids.add(msg_id)
+                processed_order.append(msg_id)
+
+        gens = [g for g in self.generations() if g >= snap_gen]
+        for gen in gens:
+            with open(self.path(gen), "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.rstrip("\n").split("\t")
+                    if parts[0] == "m" and len(parts) == 2:
+                        if parts[1] not in processed_message_ids:
+                            processed_message_ids.add(parts[1])
+                            processed_order.append(parts[1])
+                    elif len(parts) == 4 and parts[1] in by_key and parts[3].isdigit():
+                        t, w, at = by_key[parts[1]], parts[2], int(parts[3])
+                        if parts[0] == "u":
+                            t.contacts.touch_user(w, at)
+                        elif parts[0] in ("b", "f"):
+                            t.contacts.touch_bot(w, at, followup=parts[0] == "f")
+                    else:
+                        continue  # ligne tronquée (arrêt brutal)
+                    replayed += 1
+
+        self.open(max(gens + [snap_gen]) + 1)
+        print(f"[state] restored snapshot gen={snap_gen} + {replayed} journal events "
+              f"in {(time.perf_counter() - t0) * 1000:.0f} ms", flush=True)
+        return replayed
+
+
+state_journal = StateJournal(STATE_DIR)
+try:
+    if state_journal.restore():
+        # Compacte tout de suite : le prochain démarrage n'aura qu'un journal court à rejouer
+        state_journal.snapshotting = True
+        threading.Thread(target=state_journal.snapshot, daemon=True, name="snapshot").start()
+except Exception as e:
+    print("state restore error:", e, flush=True)
+    state_journal.open(max(state_journal.generations() + [0]) + 1)
+
+
+def remember_message(msg_id):
+    """
+    True si msg_id est nouveau (mémorisé + journalisé), False si doublon.
+    Test, ajout, journal et purge sous state_journal.lock : avec gunicorn --threads,
+    deux livraisons du même message ne passent pas toutes les deux, et le snapshot
+    (capture, sous le même verrou) voit une file de dédup cohérente.
+    """
+    with state_journal.lock:
+        if msg_id in processed_message_ids:
+            return False
+        processed_message_ids.add(msg_id)
+        processed_order.append(msg_id)
+        state_journal.write("m", msg_id)
+        if len(processed_order) > DEDUP_MAX:
+            while len(processed_order) > DEDUP_KEEP:
+                processed_message_ids.discard(processed_order.popleft())
+        return True
+
+
+# =====================
+# Admission Control (quotas + délestage)
+# =====================
+FALLBACK_REPLY = (
+    "Merci pour votre message 👋 Le gazon en rouleau offre une densité immédiate et fait gagner du temps "
+    "par rapport au semis, tout en demandant un entretien raisonnable (arrosage, tonte, 3 apports d’engrais/an)."
+)
+HOLD_REPLY = "Merci pour vos messages 🙂 Je reviens vers vous dans un instant."
+
+llm_slots = threading.BoundedSemaphore(LLM_MAX_INFLIGHT)
+llm_waiting = 0                      # requêtes en attente d'un slot LLM
+_llm_waiting_lock = threading.Lock()
+
+webhook_inflight = 0                 # POST /webhook en cours (compté dans before_request)
+_webhook_inflight_lock = threading.Lock()
+
+shed_counts = defaultdict(int)       # raison -> nb de délestages
+_shed_lock = threading.Lock()        # shed_counts
+shed_events = deque(maxlen=500)      # derniers délestages (pour /stats/admission) ; append atomique
+
+
+def record_shed(reason, tenant, wa_id):
+    with _shed_lock:
+        shed_counts[reason] += 1
+    shed_events.append({"at": datetime.utcnow().isoformat(), "reason": reason,
+                        "tenant": tenant.name, "wa_id": wa_id})
+    print(f"[admission] shed {reason} for {wa_id} on {tenant.name}", flush=True)
+
+
+def acquire_llm_slot():
+    """
+    Réserve un slot d'appel LLM. False (délestage) si la file d'attente dépasse
+    LLM_QUEUE_MAX ou si aucun slot ne se libère avant LLM_QUEUE_TIMEOUT.
+    """
+    global llm_waiting
+    if llm_slots.acquire(blocking=False):
+        return True
+    with _llm_waiting_lock:
+        if llm_waiting >= LLM_QUEUE_MAX:
+            return False
+        llm_waiting += 1
+    try:
+        return llm_slots.acquire(timeout=LLM_QUEUE_TIMEOUT)
+    finally:
+        with _llm_waiting_lock:
+            llm_waiting -= 1
+
+
+# =====================
+# Profiling (échantillonnage à la demande + requêtes lentes)
+# =====================
+PROFILE_HZ = float(os.getenv("PROFILE_HZ", "100"))                 # fréquence d'échantillonnage
+PROFILE_MAX_SECONDS = 120                                           # durée max d'une capture
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "3000"))      # seuil "requête lente"
+slow_requests = deque(maxlen=int(os.getenv("SLOW_REQUESTS_KEPT", "200")))  # ring buffer
+
+_timing = threading.local()          # minuteur de la requête en cours (par thread)
+_profile_lock = threading.Lock()
+profile_state = {"running": False, "started_at": None, "seconds": 0, "samples": 0, "collapsed": ""}
+
+
+def sample_stacks(seconds, hz=PROFILE_HZ):
+    """
+    Échantillonne les piles de tous les threads (requêtes + workers) pendant `seconds`.
+    Renvoie le format "collapsed" (thread;frame;frame N) lisible par flamegraph.pl / speedscope.
+    """
+    counts = defaultdict(int)
+    me = threading.get_ident()
+    interval = 1.0 / hz
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[";".join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return "\n".join(f"{k} {v}" for k, v in sorted(counts.items())), samples
+
+
+def _profile_run(seconds):
+    try:
+        collapsed, samples = sample_stacks(seconds)
+        profile_state.update(collapsed=collapsed, samples=samples)
+    except Exception as e:
+        print("profiler error:", e, flush=True)
+    finally:
+        profile_state["running"] = False
+
+
+def start_profile(seconds):
+    """Lance une capture en arrière-plan (une seule à la fois). False si déjà en cours."""
+    with _profile_lock:
+        if profile_state["running"]:
+            return False
+        profile_state.update(running=True, started_at=datetime.utcnow().isoformat(),
+                             seconds=seconds, samples=0, collapsed="")
+    threading.Thread(target=_profile_run, args=(seconds,), daemon=True, name="profiler").start()
+    return True
+
+
+@contextmanager
+def stage(name):
+    """Chronomètre une étape de la requête en cours (no-op hors requête)."""
+    stages = getattr(_timing, "stages", None)
+    if stages is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - t0) * 1000
+
+
 # =====================
 # Webhook Endpoint
 # =====================
+@app.before_request
+def _start_request_timer():
+    global webhook_inflight
+    _timing.t0 = time.perf_counter()
+    _timing.stages = {}
+    _timing.info = {}
+    _timing.counted = request.method == "POST" and request.path == "/webhook"
+    if _timing.counted:
+        with _webhook_inflight_lock:
+            webhook_inflight += 1
+
+
+@app.teardown_request
+def _record_slow_request(exc=None):
+    global webhook_inflight
+    if getattr(_timing, "counted", False):
+        _timing.counted = False
+        with _webhook_inflight_lock:
+            webhook_inflight -= 1
+    stages = getattr(_timing, "stages", None)
+    if stages is None:
+        return
+    total_ms = (time.perf_counter() - _timing.t0) * 1000
+    if total_ms >= SLOW_REQUEST_MS:
+        slow_requests.append({
+            "at": datetime.utcnow().isoformat(),
+            "path": request.path,
+            "total_ms": round(total_ms, 1),
+            "stages_ms": {k: round(v, 1) for k, v in stages.items()},
+            "other_ms": round(total_ms - sum(stages.values()), 1),
+            **_timing.info,
+        })
+        print(f"[slow] {request.path} {total_ms:.0f} ms {stages}", flush=True)
+    _timing.stages = None
+
 
 # --- Réception messages (POST) ---
 @app.route("/webhook", methods=["POST"])
 def webhook():
     try:
-        data = request.get_json(force=True, silent=True) or {}
-        print("Incoming webhook:", json.dumps(data, indent=2), flush=True)
+        raw = request.get_data(cache=True)
+        if not verify_signature(raw, request.headers.get("X-Hub-Signature-256", "")):
+            print("Webhook: invalid signature", flush=True)
+            return jsonify({"status": "invalid_signature"}), 403
+
+        # Fast path : callbacks de statut seuls (sent/delivered/read/failed), sans log détaillé
+        if b'"statuses"' in raw and b'"messages"' not in raw:
+            delivery_store.push(extract_statuses(raw))
+            return jsonify({"status": "status_recorded"}), 200
+
+        with stage("parse"):
+            data = request.get_json(force=True, silent=True) or {}
+        with stage("log"):
+            print("Incoming webhook:", json.dumps(data, indent=2), flush=True)
 
         entry = data.get("entry", [{}])[0]
         changes = entry.get("changes", [{}])[0]
         value = changes.get("value", {})
 
-        # Ignore accusés de réception/lecture
+        # Accusés de réception/lecture
         if "statuses" in value:
-            return jsonify({"status": "ignored_status"}), 200
+            delivery_store.push(extract_statuses(raw))
+            return jsonify({"status": "status_recorded"}), 200
+
+        phone_number_id = (value.get("metadata") or {}).get("phone_number_id")
+        tenant = get_tenant(phone_number_id)
+        if tenant is None:
+            print(f"Webhook: unknown phone_number_id {phone_number_id!r}, ignored", flush=True)
+            return jsonify({"status": "ignored_unknown_tenant"}), 200
 
         # Traite seulement les messages entrants
         if "messages" in value:
@@ -416,16 +1371,18 @@ def webhook():
             msg_id = msg.get("id") or ""
 
             # --- Déduplication: ignore si déjà traité ---
-            if msg_id in processed_message_ids:
+            if not remember_message(msg_id):
                 return jsonify({"status": "duplicate_ignored"}), 200
-            processed_message_ids.add(msg_id)
-            processed_order.append(msg_id)
-            if len(processed_message_ids) > 5000:
-                while len(processed_message_ids) > 4000 and processed_order:
-                    processed_message_ids.discard(processed_order.popleft())
 
             wa_id = msg.get("from")
             msg_type = msg.get("type")
+            _timing.info = {"wa_id": wa_id, "msg_id": msg_id, "tenant": tenant.name}
+
+            def feedback(typing):
+                # Retour visible immédiat, en parallèle du contexte et du LLM
+                if msg_id:
+                    feedback_pool.submit(send_read_and_typing, tenant, msg_id,
+                                         getattr(_timing, "t0", time.perf_counter()), typing)
             user_text = ""
 
             if msg_type == "text":
@@ -438,44 +1395,85 @@ def webhook():
             else:
                 user_text = "(message non-textuel reçu)"
 
-            last_user_at[wa_id] = datetime.utcnow()
-            followup_sent[wa_id] = False
+            received_at = clock.utcnow()
+            tenant.mark_user(wa_id, received_at)
             print(
-                f"[followup] GOT user msg from {wa_id} at {last_user_at[wa_id].isoformat()} : {user_text}",
+                f"[followup] GOT user msg from {wa_id} on {tenant.name} "
+                f"at {received_at.isoformat()} : {user_text}",
                 flush=True
             )
 
-            # --- Génère une réponse (OpenAI si possible, sinon fallback simple) ---
+            # --- Admission : quota par contact (un seul message d'attente par rafale) ---
             reply_text = None
+            if not tenant.admit_contact(wa_id):
+                record_shed("contact_rate", tenant, wa_id)
+                if user_text:
+                    with stage("history_write"):
+                        append_history(wa_id, "user", user_text, tenant=tenant)
+                with tenant.contact_lock:
+                    held = wa_id in tenant.contact_held
+                    tenant.contact_held.add(wa_id)
+                if held:
+                    feedback(typing=False)  # aucune réponse ne suivra : lu seulement
+                    return jsonify({"status": "shed", "reason": "contact_rate"}), 200
+                reply_text = HOLD_REPLY
+            else:
+                with tenant.contact_lock:
+                    tenant.contact_held.discard(wa_id)
+            feedback(typing=True)  # une réponse suit (LLM, attente ou fallback)
+
+            # --- Génère une réponse (OpenAI si possible, sinon fallback simple) ---
             try:
-                if OPENAI_API_KEY:
+                if OPENAI_API_KEY and reply_text is None:
                     # 1) mémoriser le message utilisateur
                     if user_text:
-                        append_history(wa_id, "user", user_text)
+                        with stage("history_write"):
+                            append_history(wa_id, "user", user_text, tenant=tenant)
 
                     # 2) recharger l'historique (20 derniers échanges)
-                    past = read_history(wa_id, limit=20)
+                    with stage("history_read"):
+                        past = read_history(wa_id, limit=20, tenant=tenant)
 
-                    # 3) prompt système complet
-                    system_prompt = GAZONS_PROMPT
+                    # 3) prompt système (propre au numéro), réduit aux sections pertinentes
+                    with stage("prompt"):
+                        system_prompt = build_system_prompt(tenant, user_text, past)
 
                     # 4) Construire le contexte avec mémoire
                     messages = [{"role": "system", "content": system_prompt}]
                     messages.extend(past)
                     messages.append({"role": "user", "content": user_text or "Bonjour"})
 
-                    # 5) Appel OpenAI
-                    chat = client.chat.completions.create(
-                        model=MODEL_NAME,          # <-- utilise bien model6 ici
-                        temperature=0.7,
-                        max_tokens=350,
-                        messages=messages
-                    )
-                    reply_text = (chat.choices[0].message.content or "").strip()
+                    # 5) Appel OpenAI (borné par LLM_MAX_INFLIGHT ; délestage -> fallback)
+                    chat = None
+                    if webhook_inflight > WEBHOOK_MAX_INFLIGHT:
+                        # threads saturés : le backlog gunicorn grossit, repli immédiat
+                        admitted, shed_reason = False, "webhook_overload"
+                    else:
+                        with stage("llm_queue"):
+                            admitted, shed_reason = acquire_llm_slot(), "llm_overload"
+                    if not admitted:
+                        record_shed(shed_reason, tenant, wa_id)
+                    else:
+                        try:
+                            with stage("openai"):
+                                chat = client.chat.completions.create(
+                                    model=MODEL_NAME,          # <-- utilise bien model6 ici
+                                    temperature=0.7,
+                                    max_tokens=350,
+                                    messages=messages
+                                )
+                        finally:
+                            llm_slots.release()
+                    reply_text = (chat.choices[0].message.content or "").strip() if chat else ""
+                    if getattr(chat, "usage", None):
+                        with prompt_stats_lock:
+                            prompt_stats["usage_prompt_tokens"] += chat.usage.prompt_tokens
+                        print(f"[prompt] usage prompt_tokens={chat.usage.prompt_tokens}", flush=True)
 
                     # 6) Mémoriser la réponse IA
                     if reply_text:
-                        append_history(wa_id, "assistant", reply_text)
+                        with stage("history_write"):
+                            append_history(wa_id, "assistant", reply_text, tenant=tenant)
 
                     # 7) Relance finale optionnelle (50%)
                     def wants_question(user_txt, ai_txt):
@@ -486,7 +1484,7 @@ def webhook():
                             return False
                         return random.random() < 0.5
 
-                    if wants_question(user_text or "", reply_text or ""):
+                    if reply_text and wants_question(user_text or "", reply_text):
                         closing_question = random.choice([
                             "Vous préférez viser l’esthétique, l’économie d’eau, ou la simplicité d’entretien ?",
                             "Souhaitez-vous qu’on estime la surface et la livraison ?",
@@ -501,16 +1499,15 @@ def webhook():
 
             if not reply_text:
                 # Fallback sans question systématique (⚠️ ta chaîne était cassée, je l’ai réparée)
-                reply_text = (
-                    "Merci pour votre message 👋 Le gazon en rouleau offre une densité immédiate et fait gagner du temps "
-                    "par rapport au semis, tout en demandant un entretien raisonnable (arrosage, tonte, 3 apports d’engrais/an)."
-                )
+                reply_text = FALLBACK_REPLY
 
             # --- Envoi WhatsApp + sortie webhook ---
             try:
-                send_whatsapp_message(wa_id, reply_text)
-                last_bot_at[wa_id] = datetime.utcnow()
-                print(f"[followup] BOT replied to {wa_id} at {last_bot_at[wa_id].isoformat()}", flush=True)
+                with stage("graph_send"):
+                    send_whatsapp_message(wa_id, reply_text, tenant=tenant)
+                replied_at = clock.utcnow()
+                tenant.mark_bot(wa_id, replied_at)
+                print(f"[followup] BOT replied to {wa_id} at {replied_at.isoformat()}", flush=True)
             except Exception as e:
                 print("send_whatsapp_message error:", e, flush=True)
             return jsonify({"status": "ok"}), 200
@@ -523,6 +1520,83 @@ def webhook():
         return jsonify({"status": "error", "detail": str(e)}), 500
 
 
+# --- Statistiques de livraison (admin) ---
+@app.route("/stats/delivery", methods=["GET"])
+def delivery_stats():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify(delivery_store.report()), 200
+
+
+# --- Tokens du prompt système (admin) ---
+@app.route("/stats/prompt", methods=["GET"])
+def prompt_token_stats():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    n = prompt_stats["requests"] or 1
+    return jsonify({
+        **prompt_stats,
+        "avg_full_tokens": round(prompt_stats["full_tokens"] / n, 1),
+        "avg_sent_tokens": round(prompt_stats["sent_tokens"] / n, 1),
+        "avg_usage_prompt_tokens": round(prompt_stats["usage_prompt_tokens"] / n, 1),
+    }), 200
+
+
+# --- Quotas / délestage (admin) ---
+@app.route("/stats/admission", methods=["GET"])
+def admission_stats():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    with _shed_lock:
+        shed_counts_copy = dict(shed_counts)
+    return jsonify({
+        "llm_max_inflight": LLM_MAX_INFLIGHT,
+        "llm_waiting": llm_waiting,
+        "llm_queue_max": LLM_QUEUE_MAX,
+        "webhook_inflight": webhook_inflight,
+        "webhook_max_inflight": WEBHOOK_MAX_INFLIGHT,
+        "shed_counts": shed_counts_copy,
+        "recent": list(shed_events)[-50:],
+    }), 200
+
+
+# --- Latence perçue : réception -> accusé de lecture / saisie (admin) ---
+@app.route("/stats/latency", methods=["GET"])
+def latency_stats():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify({"feedback_ms": percentiles(list(feedback_latency_ms))}), 200
+
+
+# --- Profiling à la demande (admin) ---
+@app.route("/admin/profile", methods=["POST"])
+def admin_profile_start():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    seconds = min(max(request.args.get("seconds", 10, type=float), 1), PROFILE_MAX_SECONDS)
+    if not start_profile(seconds):
+        return jsonify({"status": "already_running"}), 409
+    return jsonify({"status": "started", "seconds": seconds}), 202
+
+
+@app.route("/admin/profile", methods=["GET"])
+def admin_profile_result():
+    """Dernière capture au format collapsed (text/plain) ; 202 si encore en cours."""
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    if profile_state["running"]:
+        return jsonify({"status": "running", "started_at": profile_state["started_at"]}), 202
+    return Response(profile_state["collapsed"], mimetype="text/plain")
+
+
+@app.route("/admin/slow-requests", methods=["GET"])
+def admin_slow_requests():
+    if not is_admin(request):
+        return jsonify({"status": "forbidden"}), 403
+    limit = request.args.get("limit", 50, type=int)
+    return jsonify({"threshold_ms": SLOW_REQUEST_MS, "requests": list(slow_requests)[-limit:]}), 200
+
+
 # --- MAIN (unique) ---
 if __name__ == "__main__":
     import os
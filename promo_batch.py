@@ -0,0 +1,305 @@
+"""
+Génération hors ligne des promos personnalisées (hors du chemin webhook).
+
+Lit l'historique (chat_history.csv) et les clients (customers.csv) d'un dossier de
+tenant, construit une demande par client (surface, mélange évoqué, derniers messages),
+puis :
+  - mode "batch" : soumet des lots à l'API Batch d'OpenAI, et récupère les résultats
+    des lots terminés aux exécutions suivantes ;
+  - mode "local" : exécute les demandes en parallèle contre un serveur compatible
+    OpenAI (--base-url, ex. un serveur de test local).
+
+Les résultats sont ajoutés à promo_texts.jsonl (une ligne par wa_id) que
+model6.run_promo_broadcast lit le vendredi. Reprise : les wa_id déjà générés
+(ou en cours dans un lot) sont ignorés, les échecs sont retentés au passage suivant.
+
+Exemples :
+    python promo_batch.py --mode batch                 # soumet / collecte (à relancer)
+    python promo_batch.py --mode local --base-url http://localhost:8000/v1 --concurrency 32
+    python promo_batch.py --dir data/ligne_b --mode local
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from dotenv import load_dotenv
+from openai import OpenAI
+
+# Mêmes noms de fichiers que model6 (CHAT_CSV / CUSTOMER_FILE / PROMO_TEXTS_FILE)
+CHAT_CSV = "chat_history.csv"
+CUSTOMER_FILE = "customers.csv"
+PROMO_TEXTS_FILE = "promo_texts.jsonl"
+STATE_FILE = "promo_batch_state.json"
+
+HISTORY_PER_CONTACT = 8    # derniers messages pris en compte par client
+PROMO_MAX_CHARS = 300
+
+PROMO_SYSTEM_PROMPT = f"""
+Tu rédiges le message promotionnel hebdomadaire de « Gazons de la Hardt » (gazon en rouleau)
+pour un client, à partir de ses échanges passés avec notre conseiller.
+- Français, vouvoiement, ton chaleureux, 1 à 2 phrases, {PROMO_MAX_CHARS} caractères maximum.
+- Personnalise avec ce que l'on sait (surface, mélange Water Saver ou qualitatif, préparation du sol, engrais).
+- Termine en invitant à nous contacter (contact@gdlh.fr ou +33 6 71 22 75 68).
+- Ne jamais donner de prix, ni de date de livraison, ni dire que tu es une IA.
+- Réponds uniquement par le texte du message, sans guillemets ni retour à la ligne.
+""".strip()
+
+SURFACE_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(?:m²|m2|mètres? carrés?)", re.I)
+BLENDS = [
+    (re.compile(r"water\s*saver|sécheresse|secheresse|peu d.?arrosage", re.I), "Water Saver"),
+    (re.compile(r"qualitatif|elite|élite|piétinement|pietinement|premium", re.I), "mélange qualitatif"),
+]
+
+
+# =====================
+# Données : historique + profil client
+# =====================
+def load_customers(path):
+    if not path.exists():
+        return []
+    with path.open("r", encoding="utf-8") as f:
+        return list(dict.fromkeys(line.strip() for line in f if line.strip()))
+
+
+def load_histories(path, wa_ids):
+    """Un seul passage sur le CSV : derniers messages par wa_id (format append_history)."""
+    wanted = set(wa_ids)
+    histories = defaultdict(lambda: deque(maxlen=HISTORY_PER_CONTACT))
+    if not path.exists():
+        return histories
+    with path.open("r", newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if len(row) < 4 or row[0] not in wanted:
+                continue
+            histories[row[0]].append((row[1], row[2]))
+    return histories
+
+
+def profile(messages):
+    """Indices utiles extraits de l'historique : surface (m²) et mélange évoqué."""
+    text = " ".join(content for _role, content in messages)
+    hints = {}
+    surfaces = SURFACE_RE.findall(text)
+    if surfaces:
+        hints["surface_m2"] = surfaces[-1].replace(",", ".")
+    # Mélange évoqué en dernier dans la conversation (position de la dernière occurrence)
+    last = max(((m.start(), blend) for pattern, blend in BLENDS for m in pattern.finditer(text)),
+               default=None)
+    if last:
+        hints["melange"] = last[1]
+    return hints
+
+
+def build_request(wa_id, messages, model):
+    """Corps /v1/chat/completions pour un client."""
+    lines = [f"Profil : {json.dumps(profile(messages), ensure_ascii=False)}", "Derniers échanges :"]
+    for role, content in messages:
+        who = "Client" if role == "user" else "Conseiller"
+        lines.append(f"- {who} : {content[:300]}")
+    return {
+        "model": model,
+        "temperature": 0.7,
+        "max_tokens": 160,
+        "messages": [
+            {"role": "system", "content": PROMO_SYSTEM_PROMPT},
+            {"role": "user", "content": "\n".join(lines)},
+        ],
+    }
+
+
+def clean_text(text):
+    """Variable de template WhatsApp : pas de retour à la ligne ni d'espaces multiples."""
+    text = re.sub(r"\s+", " ", (text or "").strip().strip('"«» '))
+    return text[:PROMO_MAX_CHARS]
+
+
+# =====================
+# Résultats (append-only) + état des lots
+# =====================
+class ResultStore:
+    """promo_texts.jsonl : une ligne par texte généré ; la dernière ligne d'un wa_id fait foi."""
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.lock = threading.Lock()
+        cutoff = (datetime.utcnow() - max_age).isoformat()
+        self.done = set()
+        if path.exists():
+            with path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if rec.get("text") and rec.get("generated_at", "") >= cutoff:
+                        self.done.add(rec["wa_id"])
+
+    def add(self, wa_id, text, source):
+        text = clean_text(text)
+        if not text:
+            return False
+        rec = {"wa_id": wa_id, "text": text, "generated_at": datetime.utcnow().isoformat(), "source": source}
+        with self.lock:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.done.add(wa_id)
+        return True
+
+
+def load_state(path):
+    if path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"batches": {}}
+
+
+def save_state(path, state):
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+# =====================
+# Mode batch (API Batch OpenAI)
+# =====================
+def collect_batches(client, state, store, stats):
+    """Récupère les lots terminés ; les wa_id sans résultat redeviennent à traiter."""
+    for batch_id, info in list(state["batches"].items()):
+        batch = client.batches.retrieve(batch_id)
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            print(f"[batch] {batch_id}: {batch.status} ({len(info['ids'])} demandes)")
+            continue
+        if batch.output_file_id:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                rec = json.loads(line)
+                body = (rec.get("response") or {}).get("body") or {}
+                choices = body.get("choices") or []
+                if rec.get("error") or not choices:
+                    stats["failed"] += 1
+                    continue
+                if store.add(rec["custom_id"], choices[0]["message"]["content"], "batch"):
+                    stats["done"] += 1
+                    stats["tokens"] += (body.get("usage") or {}).get("total_tokens", 0)
+        elapsed = (batch.completed_at or time.time()) - batch.created_at if batch.created_at else 0
+        print(f"[batch] {batch_id}: {batch.status}, {len(info['ids'])} demandes en {elapsed:.0f} s")
+        del state["batches"][batch_id]
+
+
+def submit_batches(client, pending, histories, args, state):
+    """Découpe en lots de --chunk-size et les soumet ; les IDs sont mémorisés pour la reprise."""
+    for start in range(0, len(pending), args.chunk_size):
+        chunk = pending[start:start + args.chunk_size]
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as f:
+            for wa_id in chunk:
+                f.write(json.dumps({
+                    "custom_id": wa_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": build_request(wa_id, histories[wa_id], args.model),
+                }, ensure_ascii=False) + "\n")
+            path = f.name
+        try:
+            with open(path, "rb") as fh:
+                uploaded = client.files.create(file=fh, purpose="batch")
+        finally:
+            os.unlink(path)
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        state["batches"][batch.id] = {"ids": chunk, "submitted_at": datetime.utcnow().isoformat()}
+        print(f"[batch] soumis {batch.id}: {len(chunk)} demandes")
+
+
+# =====================
+# Mode local (exécution concurrente)
+# =====================
+def run_local(client, pending, histories, args, store, stats):
+    def generate(wa_id):
+        chat = client.chat.completions.create(**build_request(wa_id, histories[wa_id], args.model))
+        usage = getattr(chat, "usage", None)
+        return wa_id, chat.choices[0].message.content, usage.total_tokens if usage else 0
+
+    for start in range(0, len(pending), args.chunk_size):
+        chunk = pending[start:start + args.chunk_size]
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(generate, wa_id) for wa_id in chunk]
+            for fut in as_completed(futures):
+                try:
+                    wa_id, text, tokens = fut.result()
+                except Exception as e:
+                    stats["failed"] += 1
+                    print("[local] error:", e)
+                    continue
+                if store.add(wa_id, text, "local"):
+                    stats["done"] += 1
+                    stats["tokens"] += tokens
+                else:
+                    stats["failed"] += 1
+        rate = len(chunk) / (time.perf_counter() - t0)
+        print(f"[local] lot {start // args.chunk_size + 1}: {len(chunk)} demandes, {rate:.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=".", help="dossier du tenant (racine ou data/<namespace>)")
+    parser.add_argument("--mode", choices=("batch", "local"), default="batch")
+    parser.add_argument("--model", default=None, help="modèle (défaut : OPENAI_MODEL ou gpt-4o-mini)")
+    parser.add_argument("--base-url", default=None, help="serveur compatible OpenAI (mode local)")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="demandes par lot")
+    parser.add_argument("--concurrency", type=int, default=16, help="requêtes simultanées (mode local)")
+    parser.add_argument("--max-age-days", type=int, default=int(os.getenv("PROMO_TEXT_MAX_AGE_DAYS", "7")),
+                        help="un texte plus récent n'est pas régénéré")
+    parser.add_argument("--limit", type=int, default=0, help="nb max de clients traités (0 = tous)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    args.model = args.model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    base = Path(args.dir)
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", "local"), base_url=args.base_url, max_retries=3)
+
+    t0 = time.perf_counter()
+    store = ResultStore(base / PROMO_TEXTS_FILE, timedelta(days=args.max_age_days))
+    state_path = base / STATE_FILE
+    state = load_state(state_path)
+    stats = {"done": 0, "failed": 0, "tokens": 0}
+
+    if args.mode == "batch" and state["batches"]:
+        collect_batches(client, state, store, stats)
+        save_state(state_path, state)
+
+    customers = load_customers(base / CUSTOMER_FILE)
+    histories = load_histories(base / CHAT_CSV, customers)
+    in_flight = {wa_id for info in state["batches"].values() for wa_id in info["ids"]}
+    pending = [w for w in customers if w in histories and w not in store.done and w not in in_flight]
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"[promo] {len(customers)} clients, {len(histories)} avec historique, "
+          f"{len(store.done)} déjà générés, {len(in_flight)} en cours, {len(pending)} à traiter")
+
+    if pending:
+        if args.mode == "batch":
+            submit_batches(client, pending, histories, args, state)
+            save_state(state_path, state)
+        else:
+            run_local(client, pending, histories, args, store, stats)
+
+    elapsed = time.perf_counter() - t0
+    print(f"[promo] générés={stats['done']} échecs={stats['failed']} tokens={stats['tokens']} "
+          f"durée={elapsed:.1f} s débit={stats['done'] / elapsed:.1f} textes/s")
+
+
+if __name__ == "__main__":
+    main()
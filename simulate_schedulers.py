@@ -0,0 +1,176 @@
+"""
+Simulation à horloge virtuelle des relances (followup_tick) et de la promo hebdo.
+
+Rejoue une population synthétique de contacts contre les vrais schedulers de model6,
+avec un faux envoi (aucun appel Graph / OpenAI), en accéléré.
+
+Rapport : CPU par tick (thread principal : les snapshots d'état tournent dans leurs
+propres threads), mémoire (RSS), nb d'envois par heure simulée.
+
+Exemples :
+    python simulate_schedulers.py --contacts 100000 --hours 12
+    python simulate_schedulers.py --contacts 10000,100000,200000 --hours 6 --tick 60
+"""
+import argparse
+import contextlib
+import heapq
+import io
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+
+class VirtualClock:
+    """Horloge injectable dans model6 (même interface que SystemClock)."""
+
+    def __init__(self, start):
+        self.current = start
+
+    def utcnow(self):
+        return self.current
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=seconds)
+
+
+def rss_mb():
+    """RSS courant (Linux) ; à défaut le pic (ru_maxrss)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def import_model6(workdir):
+    """Importe model6 dans un dossier temporaire (fichiers CSV jetables, logs par contact coupés)."""
+    os.environ.setdefault("OPENAI_API_KEY", "sim-not-used")
+    os.environ.setdefault("PHONE_NUMBER_ID", "sim")
+    os.environ["FOLLOWUP_DEBUG"] = "0"
+    os.environ["TENANTS_FILE"] = os.path.join(workdir, "no-tenants.json")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import model6
+    finally:
+        os.chdir(cwd)
+    return model6
+
+
+def simulate(model6, contacts, hours, tick, msgs_per_day, reply_delay, seed, start):
+    rng = random.Random(seed)
+    vclock = VirtualClock(start)
+    model6.clock = vclock
+    model6.last_promo_date = None
+    model6.next_promo_at = None
+
+    tenant = model6.DEFAULT_TENANT
+    tenant.contacts = model6.ContactTable()
+    tenant.customers.clear()
+
+    wa_ids = [f"33{600000000 + i}" for i in range(contacts)]
+    tenant.customers.update(wa_ids)
+
+    # Arrivées de messages clients : processus de Poisson par contact
+    rate = msgs_per_day / 86400.0
+    arrivals = [(start + timedelta(seconds=rng.expovariate(rate)), i) for i in range(contacts)]
+    heapq.heapify(arrivals)
+
+    sends = defaultdict(lambda: {"nudge": 0, "promo": 0})
+
+    def fake_send(wa_id, text=None, kind="promo", tenant=None):
+        sends[int((vclock.current - start).total_seconds() // 3600)][kind] += 1
+
+    end = start + timedelta(hours=hours)
+    tick_cpu = []
+    rss_start = rss_mb()
+    sink = io.StringIO()
+
+    while vclock.current < end:
+        vclock.advance(tick)
+        now = vclock.current
+
+        # Messages clients arrivés depuis le tick précédent (+ réponse du bot)
+        while arrivals and arrivals[0][0] <= now:
+            at, i = heapq.heappop(arrivals)
+            wa_id = wa_ids[i]
+            tenant.contacts.touch_user(wa_id, model6.to_epoch(at))
+            tenant.contacts.touch_bot(wa_id, model6.to_epoch(at + timedelta(seconds=reply_delay)))
+            heapq.heappush(arrivals, (at + timedelta(seconds=rng.expovariate(rate)), i))
+
+        # Mêmes points d'entrée que followup_worker / promotion_worker
+        cpu0 = time.thread_time()
+        with contextlib.redirect_stdout(sink):
+            model6.run_followups(now=now, send=fake_send)
+            model6.promotion_tick(now=now, send=fake_send)
+        tick_cpu.append((time.thread_time() - cpu0) * 1000)
+        sink.seek(0)
+        sink.truncate()
+
+    tick_cpu.sort()
+    return {
+        "contacts": contacts,
+        "tracked": len(tenant.contacts),
+        "ticks": len(tick_cpu),
+        "cpu_ms_mean": sum(tick_cpu) / len(tick_cpu),
+        "cpu_ms_p95": tick_cpu[int(len(tick_cpu) * 0.95)],
+        "cpu_ms_max": tick_cpu[-1],
+        "rss_mb": rss_mb(),
+        "rss_delta_mb": rss_mb() - rss_start,
+        "sends": dict(sends),
+    }
+
+
+def print_report(result, hours):
+    print(f"\n=== {result['contacts']} contacts ({result['tracked']} suivis), "
+          f"{result['ticks']} ticks ===")
+    print(f"CPU/tick : moyenne {result['cpu_ms_mean']:.1f} ms, p95 {result['cpu_ms_p95']:.1f} ms, "
+          f"max {result['cpu_ms_max']:.1f} ms")
+    print(f"Mémoire  : RSS {result['rss_mb']:.0f} Mo (+{result['rss_delta_mb']:.0f} Mo pendant la simulation)")
+    print("Heure  relances  promos")
+    for h in range(int(hours)):
+        c = result["sends"].get(h, {"nudge": 0, "promo": 0})
+        print(f"{h:5d}  {c['nudge']:8d}  {c['promo']:6d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contacts", default="100000", help="taille(s) de population, ex. 10000,100000")
+    parser.add_argument("--hours", type=float, default=12, help="durée simulée (heures)")
+    parser.add_argument("--tick", type=float, default=20, help="période du followup_worker (s simulées)")
+    parser.add_argument("--msgs-per-day", type=float, default=2, help="messages clients / contact / jour")
+    parser.add_argument("--reply-delay", type=float, default=5, help="délai de réponse du bot (s)")
+    parser.add_argument("--start", default="2025-09-19T18:00:00",
+                        help="début (ISO) ; par défaut un vendredi avant la promo de 20:59")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        model6 = import_model6(workdir)
+        start = datetime.fromisoformat(args.start)
+        for contacts in (int(c) for c in args.contacts.split(",")):
+            t0 = time.perf_counter()
+            result = simulate(model6, contacts, args.hours, args.tick, args.msgs_per_day,
+                              args.reply_delay, args.seed, start)
+            print_report(result, args.hours)
+            print(f"Durée réelle : {time.perf_counter() - t0:.1f} s "
+                  f"(x{args.hours * 3600 / (time.perf_counter() - t0):.0f})")
+
+
+if __name__ == "__main__":
+    main()